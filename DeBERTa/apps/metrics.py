@@ -4,13 +4,41 @@ from sklearn.metrics import accuracy_score,f1_score
 from scipy.stats import pearsonr, spearmanr
 from statistics import *
 from scipy.special import softmax
+try:
+  import numba
+except ImportError:
+  numba = None
 
 def metric_multi_accuracy(logits, labels, options_num):
   logits = np.reshape(softmax(logits, -1)[:,1], (len(logits)//options_num, options_num))
   labels = np.argmax(np.reshape(labels, (len(labels)//options_num, options_num)),-1)
   return metric_accuracy(logits, labels)
 
+if numba is not None:
+  @numba.njit(cache=True, parallel=True)
+  def _argmax_accuracy(logits, labels):
+    # Fused argmax and comparison in a single pass over the logits. Like np.argmax, the first NaN is the maximum.
+    n, c = logits.shape
+    correct = 0
+    for i in numba.prange(n):
+      best = 0
+      if not np.isnan(logits[i, 0]):
+        for j in range(1, c):
+          v = logits[i, j]
+          if np.isnan(v):
+            best = j
+            break
+          if v > logits[i, best]:
+            best = j
+      if best == labels[i]:
+        correct += 1
+    return correct/n
+
 def metric_accuracy(logits, labels):
+  labels = np.asarray(labels)
+  if numba is not None and len(labels)>0 and logits.ndim==2 and labels.ndim==1 and logits.shape[0]==labels.shape[0] \
+      and logits.dtype in (np.float32, np.float64) and labels.dtype.kind in 'iu':
+    return float(_argmax_accuracy(logits, labels))
   predicts = np.argmax(logits, axis=1)
   return accuracy_score(labels, predicts)
 
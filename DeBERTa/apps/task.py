@@ -35,6 +35,8 @@ class EvalData:
     self.critial_metrics = critial_metrics
     self.metrics_fn = metrics_fn if metrics_fn is not None else accuracy_fn
     self.predict_fn = predict_fn if predict_fn is not None else default_pred_fn
+    # (key, loader) of the DataLoader reused across evaluations, it lives as long as this eval data
+    self.dataloader_cache = None
 
   def __repr__(self):
     return f'{self.name}, {type(self.data)}: {len(self.data)}, {self.predict_fn}, {self.metrics_fn}'
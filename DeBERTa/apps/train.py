@@ -19,15 +19,19 @@ import numpy as np
 import math
 import torch
 import json
+from packaging import version
 from torch.utils.data import DataLoader
 from ..deberta import GPT2Tokenizer
 from ..utils import *
 from ..utils import xtqdm as tqdm
 from .task_registry import tasks
 
-from ..training import DistributedTrainer, initialize_distributed, batch_to, set_random_seed,kill_children
+from ..training import DistributedTrainer, initialize_distributed, batch_to, packed_collate, set_random_seed,kill_children
 from ..data import DistributedBatchSampler, SequentialSampler, BatchSampler, AsyncDataLoader
 
+# Expandable segments and the memory history snapshots of the cuda allocator are only available from torch 2.1
+_TORCH_2_1 = version.parse(torch.__version__).release >= (2, 1)
+
 def create_model(args, num_labels, model_class_fn):
   # Prepare model
   rank = getattr(args, 'rank', 0)
@@ -35,9 +39,6 @@ def create_model(args, num_labels, model_class_fn):
   model = model_class_fn(init_model, args.model_config, num_labels=num_labels, \
       drop_out=args.cls_drop_out, \
       pre_trained = args.pre_trained)
-  if args.fp16:
-    model = model.half()
-
   return model
 
 def train_model(args, model, device, train_data, eval_data):
@@ -51,6 +52,9 @@ def train_model(args, model, device, train_data, eval_data):
 
   def eval_fn(trainer, model, device, tag):
     results = run_eval(trainer.args, model, device, eval_data, tag, steps=trainer.trainer_state.steps)
+    if trainer.args.rank>0:
+      # Only rank 0 holds the merged predictions and computes the metrics
+      return None
     eval_metric = np.mean([v[0] for k,v in results.items() if 'train' not in k])
     return eval_metric
 
@@ -62,41 +66,116 @@ def train_model(args, model, device, train_data, eval_data):
   trainer.train()
 
 def merge_distributed(data_list, max_len=None):
-  merged = []
-  def gather(data):
-    data_chunks = [torch.zeros_like(data) for _ in range(args.world_size)]
-    torch.distributed.all_gather(data_chunks, data)
-    torch.cuda.synchronize()
-    return data_chunks
-
-  for data in data_list:
-    if torch.distributed.is_initialized() and torch.distributed.get_world_size()>1:
-      if isinstance(data, Sequence):
-        data_chunks = []
-        for d in data:
-          chunks_ = gather(d)
-          data_ = torch.cat(chunks_)
-          data_chunks.append(data_)
-        merged.append(data_chunks)
-      else:
-        data_chunks = gather(data)
-        merged.extend(data_chunks)
+  """Merge the per-batch outputs of all ranks. In distributed runs the merged data is only returned on rank 0, other ranks get `None`.
+  On a single process the outputs are merged into host tensors.
+  """
+  dist_on = torch.distributed.is_initialized() and torch.distributed.get_world_size()>1
+  if not dist_on:
+    if not isinstance(data_list[0], Sequence):
+      return _merge_to_host(data_list, max_len)
+    return [_merge_to_host(list(d), max_len) for d in zip(*data_list)]
+
+  ws = torch.distributed.get_world_size()
+  rank = torch.distributed.get_rank()
+  # DistributedBatchSampler pads every batch to a multiple of the world size, so all ranks hold the same number
+  # of rows for each batch and the outputs of all batches can be sent with a single collective.
+  def gather(chunks):
+    sizes = [c.size(0) for c in chunks]
+    local = torch.cat(chunks)
+    gathered = [torch.empty_like(local) for _ in range(ws)] if rank==0 else None
+    torch.distributed.gather(local, gathered, dst=0)
+    if rank>0:
+      return None
+    # Restore the sample order, i.e. the chunks of all ranks for the first batch, then for the second batch...
+    splits = [g.split(sizes) for g in gathered]
+    return torch.cat([sp[i] for i in range(len(sizes)) for sp in splits])[:max_len]
+
+  if not isinstance(data_list[0], Sequence):
+    return gather(data_list)
+  merged = [gather(list(d)) for d in zip(*data_list)]
+  return merged if rank==0 else None
+
+def _merge_to_host(chunks, max_len=None):
+  # The merged outputs end up on the host anyway, stream the chunks into a host buffer instead of concatenating them on the device
+  collector = OutputCollector(sum(c.size(0) for c in chunks), chunks[0].device)
+  for c in chunks:
+    collector.append(c)
+  return collector.merge(max_len)
+
+class OutputCollector:
+  """Collect the per-batch outputs of an evaluation pass.
+
+  On a single process the outputs are streamed into a pinned host buffer on a side cuda stream,
+  so that the device to host copy of batch N overlaps with the forward pass of batch N+1.
+  In distributed runs the device tensors are kept and merged with `merge_distributed`.
+  """
+  def __init__(self, total, device, distributed=False):
+    self.total = total
+    self.distributed = distributed
+    self.pin_memory = device.type == 'cuda'
+    self.stream = torch.cuda.Stream(device) if self.pin_memory and not distributed else None
+    self.host = None
+    self.offset = 0
+    self.chunks = []
+
+  def append(self, data):
+    if self.distributed or not isinstance(data, torch.Tensor):
+      self.chunks.append(data)
+      return
+    data = data.detach()
+    if self.host is None:
+      self.host = torch.empty((self.total,) + data.shape[1:], dtype=data.dtype, pin_memory=self.pin_memory)
+    end = self.offset + data.size(0)
+    if self.stream is not None:
+      self.stream.wait_stream(torch.cuda.current_stream(data.device))
+      with torch.cuda.stream(self.stream):
+        self.host[self.offset:end].copy_(data, non_blocking=True)
+      # The copy runs on the side stream, keep the allocator from reusing the source too early
+      data.record_stream(self.stream)
     else:
-      merged.append(data)
-  if not isinstance(merged[0], Sequence):
-    merged = torch.cat(merged)
-    if max_len is not None:
-      return merged[:max_len]
-    else:
-      return merged
+      self.host[self.offset:end].copy_(data)
+    self.offset = end
+
+  def merge(self, max_len=None):
+    if len(self.chunks)>0:
+      return merge_distributed(self.chunks, max_len)
+    if self.stream is not None:
+      self.stream.synchronize()
+    end = self.offset if max_len is None else min(self.offset, max_len)
+    return self.host[:end]
+
+def to_numpy(data):
+  # Host tensors, e.g. the pinned buffers of OutputCollector, are shared with numpy without a copy
+  if data.device.type == 'cpu' and not data.requires_grad:
+    return data.numpy()
+  return data.detach().cpu().numpy()
+
+def get_eval_dataloader(args, eval_item):
+  # The eval data doesn't change between evaluations, e.g. the periodic evaluations during training,
+  # so the loader and its persistent workers are kept on the eval item and released together with it.
+  key = (args.eval_batch_size, args.rank, args.world_size, args.workers)
+  cached = getattr(eval_item, 'dataloader_cache', None)
+  if cached is not None and cached[0] == key:
+    return cached[1]
+  eval_sampler = SequentialSampler(len(eval_item.data))
+  batch_sampler = BatchSampler(eval_sampler, args.eval_batch_size)
+  batch_sampler = DistributedBatchSampler(batch_sampler, rank=args.rank, world_size=args.world_size)
+  # Worker options are only accepted by DataLoader when loading with sub-processes
+  worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.workers>0 else {}
+  eval_dataloader = DataLoader(eval_item.data, batch_sampler=batch_sampler, num_workers=args.workers, collate_fn=packed_collate, pin_memory=True, **worker_kwargs)
+  eval_item.dataloader_cache = (key, eval_dataloader)
+  return eval_dataloader
+
+def dump_array(path, data, binary=False):
+  """Dump an array as tab separated text, or as a binary `.npy` file when `binary` is set. Return the path written."""
+  if binary:
+    path = os.path.splitext(path)[0] + '.npy'
+    np.save(path, data)
   else:
-    data_list=[]
-    for d in zip(*merged):
-      data = torch.cat(d)
-      if max_len is not None:
-        data = data[:max_len]
-      data_list.append(data)
-    return data_list
+    np.savetxt(path, data, delimiter='\t')
+  return path
+
+_IGNORE_SUFFIXES = ('/eval_samples', '/eval_loss')
 
 def calc_metrics(predicts, labels, eval_loss, eval_item, eval_results, args, name, prefix, steps, tag):
   tb_metrics = OrderedDict()
@@ -115,68 +194,67 @@ def calc_metrics(predicts, labels, eval_loss, eval_item, eval_results, args, nam
   result['eval_samples'] = len(labels)
   if args.rank<=0:
     output_eval_file = os.path.join(args.output_dir, "eval_results_{}_{}.txt".format(name, prefix))
+    sorted_items = sorted(result.items())
+    tb_metrics.update((f'{name}/{k}', v) for k,v in sorted_items)
+    logger.info("***** Eval results-{}-{} *****\n".format(name, prefix) + '\n'.join(f'  {k} = {v}' for k,v in sorted_items))
     with open(output_eval_file, 'w', encoding='utf-8') as writer:
-      logger.info("***** Eval results-{}-{} *****".format(name, prefix))
-      for key in sorted(result.keys()):
-        logger.info("  %s = %s", key, str(result[key]))
-        writer.write("%s = %s\n" % (key, str(result[key])))
-        tb_metrics[f'{name}/{key}'] = result[key]
+      writer.writelines(f'{k} = {v}\n' for k,v in sorted_items)
 
     if predict_fn is not None:
       predict_fn(predicts, args.output_dir, name, prefix)
     else:
       output_predict_file = os.path.join(args.output_dir, "predict_results_{}_{}.txt".format(name, prefix))
-      np.savetxt(output_predict_file, predicts, delimiter='\t')
+      dump_array(output_predict_file, predicts, args.dump_binary)
       output_label_file = os.path.join(args.output_dir, "predict_labels_{}_{}.txt".format(name, prefix))
-      np.savetxt(output_label_file, labels, delimiter='\t')
+      dump_array(output_label_file, labels, args.dump_binary)
 
   if not eval_item.ignore_metric:
     eval_results[name]=(eval_metric, predicts, labels)
   _tag = tag + '/' if tag is not None else ''
   def _ignore(k):
-    ig = ['/eval_samples', '/eval_loss']
-    for i in ig:
-      if k.endswith(i):
-        return True
-    return False
+    return k.endswith(_IGNORE_SUFFIXES)
 
 def run_eval(args, model, device, eval_data, prefix=None, tag=None, steps=None):
-  # Run prediction for full data
+  # Run prediction for full data. The results are only returned on rank 0, other ranks get an empty dict.
   prefix = f'{tag}_{prefix}' if tag is not None else prefix
   eval_results=OrderedDict()
   eval_metric=0
   no_tqdm = (True if os.getenv('NO_TQDM', '0')!='0' else False) or args.rank>0
+  # Keep the numerically sensitive ops, e.g. softmax and layer norm, in fp32 for fp16 runs
+  use_amp = args.fp16 and device.type == 'cuda'
   for eval_item in eval_data:
     name = eval_item.name
-    eval_sampler = SequentialSampler(len(eval_item.data))
-    batch_sampler = BatchSampler(eval_sampler, args.eval_batch_size)
-    batch_sampler = DistributedBatchSampler(batch_sampler, rank=args.rank, world_size=args.world_size)
-    eval_dataloader = DataLoader(eval_item.data, batch_sampler=batch_sampler, num_workers=args.workers)
+    eval_dataloader = get_eval_dataloader(args, eval_item)
     model.eval()
-    eval_loss, eval_accuracy = 0, 0
+    eval_loss, eval_accuracy = torch.zeros((), device=device), 0
     nb_eval_steps, nb_eval_examples = 0, 0
-    predicts=[]
-    labels=[]
+    predicts = OutputCollector(len(eval_item.data), device, args.world_size>1)
+    labels = OutputCollector(len(eval_item.data), device, args.world_size>1)
     for batch in tqdm(AsyncDataLoader(eval_dataloader), ncols=80, desc='Evaluating: {}'.format(prefix), disable=no_tqdm):
       batch = batch_to(batch, device)
-      with torch.no_grad():
+      with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
         logits, tmp_eval_loss = model(**batch)
-      label_ids = batch['labels'].to(device)
+      # The labels are a view into the packed batch buffer, copy them so that the kept chunks don't hold the whole batch
+      label_ids = batch['labels'].to(device).clone()
       predicts.append(logits)
       labels.append(label_ids)
-      eval_loss += tmp_eval_loss.mean().item()
+      # Keep the running loss on device to avoid a host sync per batch
+      eval_loss += tmp_eval_loss.detach().mean().float()
       input_ids = batch['input_ids']
       nb_eval_examples += input_ids.size(0)
       nb_eval_steps += 1
 
-    eval_loss = eval_loss / nb_eval_steps
-    predicts = merge_distributed(predicts, len(eval_item.data))
-    labels = merge_distributed(labels, len(eval_item.data))
+    eval_loss = (eval_loss / nb_eval_steps).item()
+    predicts = predicts.merge(len(eval_item.data))
+    labels = labels.merge(len(eval_item.data))
+    if args.rank>0:
+      continue
+    labels = to_numpy(labels)
     if isinstance(predicts, Sequence):
       for k,pred in enumerate(predicts):
-        calc_metrics(pred.detach().cpu().numpy(), labels.detach().cpu().numpy(), eval_loss, eval_item, eval_results, args, name + f'@{k}', prefix, steps, tag)
+        calc_metrics(to_numpy(pred), labels, eval_loss, eval_item, eval_results, args, name + f'@{k}', prefix, steps, tag)
     else:
-      calc_metrics(predicts.detach().cpu().numpy(), labels.detach().cpu().numpy(), eval_loss, eval_item, eval_results, args, name, prefix, steps, tag)
+      calc_metrics(to_numpy(predicts), labels, eval_loss, eval_item, eval_results, args, name, prefix, steps, tag)
 
   return eval_results
 
@@ -184,50 +262,57 @@ def run_predict(args, model, device, eval_data, prefix=None):
   # Run prediction for full data
   eval_results=OrderedDict()
   eval_metric=0
+  use_amp = args.fp16 and device.type == 'cuda'
   for eval_item in eval_data:
     name = eval_item.name
-    eval_sampler = SequentialSampler(len(eval_item.data))
-    batch_sampler = BatchSampler(eval_sampler, args.eval_batch_size)
-    batch_sampler = DistributedBatchSampler(batch_sampler, rank=args.rank, world_size=args.world_size)
-    eval_dataloader = DataLoader(eval_item.data, batch_sampler=batch_sampler, num_workers=args.workers)
+    eval_dataloader = get_eval_dataloader(args, eval_item)
     model.eval()
-    predicts=None
+    predicts = OutputCollector(len(eval_item.data), device, args.world_size>1)
     for batch in tqdm(AsyncDataLoader(eval_dataloader), ncols=80, desc='Evaluating: {}'.format(prefix), disable=args.rank>0):
       batch = batch_to(batch, device)
-      with torch.no_grad():
+      with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
         logits, _ = model(**batch)
-      if args.world_size>1:
-        logits_all = [torch.zeros_like(logits) for _ in range(args.world_size)]
-        torch.distributed.all_gather(logits_all, logits)
-        torch.cuda.synchronize()
-        logits = torch.cat(logits_all)
-      logits = logits.detach().cpu().numpy()
-      if predicts is None:
-        predicts = np.copy(logits)
-      else:
-        predicts = np.append(predicts, logits, axis=0)
-  
-    predicts = predicts[:len(eval_item.data)]
-    if args.rank<=0:
-      output_test_file = os.path.join(args.output_dir, "test_logits_{}_{}.txt".format(name, prefix))
-      logger.info("***** Dump prediction results-{}-{} *****".format(name, prefix))
-      logger.info("Location: {}".format(output_test_file))
-      np.savetxt(output_test_file, predicts, delimiter='\t')
-      predict_fn = eval_item.predict_fn
-      if predict_fn:
-        predict_fn(predicts, args.output_dir, name, prefix)
+      predicts.append(logits)
+
+    predicts = predicts.merge(len(eval_item.data))
+    if args.rank>0:
+      continue
+    predicts = to_numpy(predicts)
+    output_test_file = os.path.join(args.output_dir, "test_logits_{}_{}.txt".format(name, prefix))
+    logger.info("***** Dump prediction results-{}-{} *****".format(name, prefix))
+    output_test_file = dump_array(output_test_file, predicts, args.dump_binary)
+    logger.info("Location: {}".format(output_test_file))
+    predict_fn = eval_item.predict_fn
+    if predict_fn:
+      predict_fn(predicts, args.output_dir, name, prefix)
+
+_TOKENIZER_CACHE = {}
+_PROCESSOR_CACHE = {}
+
+def get_processor(task_name, data_dir, max_seq_len):
+  # Reuse the tokenizer and task processor when main is called repeatedly in the same process
+  key = (task_name, data_dir, max_seq_len)
+  if key not in _PROCESSOR_CACHE:
+    if 'gpt2' not in _TOKENIZER_CACHE:
+      _TOKENIZER_CACHE['gpt2'] = GPT2Tokenizer()
+    tokenizer = _TOKENIZER_CACHE['gpt2']
+    _PROCESSOR_CACHE[key] = tasks[task_name](tokenizer = tokenizer, max_seq_len = max_seq_len, data_dir = data_dir)
+  return _PROCESSOR_CACHE[key]
 
 def main(args):
   if not args.do_train and not args.do_eval and not args.do_predict:
     raise ValueError("At least one of `do_train` or `do_eval` or `do_predict` must be True.")
+  # Must be set before the first cuda allocation to take effect. Expandable segments reduce the fragmentation
+  # caused by the variable sized eval batches.
+  if _TORCH_2_1:
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128')
   os.makedirs(args.output_dir, exist_ok=True)
   task_name = args.task_name.lower()
   random.seed(args.seed)
   np.random.seed(args.seed)
   torch.manual_seed(args.seed)
 
-  tokenizer = GPT2Tokenizer()
-  processor = tasks[task_name](tokenizer = tokenizer, max_seq_len = args.max_seq_length, data_dir = args.data_dir)
+  processor = get_processor(task_name, args.data_dir, args.max_seq_length)
   label_list = processor.get_labels()
 
   eval_data = processor.eval_data(max_seq_len=args.max_seq_length)
@@ -247,16 +332,33 @@ def main(args):
   device = initialize_distributed(args)
   if not isinstance(device, torch.device):
     return 0
-  model.to(device)
+  # Cast while moving so that the full precision weights are never duplicated on the host
+  if args.fp16:
+    model.to(device, dtype=torch.float16)
+  else:
+    model.to(device)
+  record_memory = args.record_memory and device.type == 'cuda'
+  if record_memory and not _TORCH_2_1:
+    logger.warning(f'Recording cuda memory history requires torch 2.1 or later, disabled on torch {torch.__version__}')
+    record_memory = False
+  if record_memory:
+    torch.cuda.memory._record_memory_history()
   if args.do_eval:
     run_eval(args, model, device, eval_data, prefix=args.tag)
 
   if args.do_train:
     train_model(args, model, device, train_data, eval_data)
+    if device.type == 'cuda':
+      torch.cuda.empty_cache()
 
   if args.do_predict:
     run_predict(args, model, device, test_data, prefix=args.tag)
 
+  if record_memory:
+    snapshot_file = os.path.join(args.output_dir, f'cuda_memory_{args.rank}.pickle')
+    torch.cuda.memory._dump_snapshot(snapshot_file)
+    logger.info(f'Cuda memory snapshot: {snapshot_file}')
+
 def build_argument_parser():
   parser = argparse.ArgumentParser()
 
@@ -433,6 +535,16 @@ def build_argument_parser():
             type=boolean_string,
             help="Whether to cache cooked binary features")
 
+  parser.add_argument('--record_memory',
+            default=False,
+            type=boolean_string,
+            help="Whether to record the cuda memory history and dump a snapshot to the output dir")
+
+  parser.add_argument('--dump_binary',
+            default=False,
+            type=boolean_string,
+            help="Whether to dump prediction results as binary .npy files instead of text")
+
   parser.add_argument('--pre_trained',
             default=None,
             type=str,
@@ -215,7 +215,6 @@ class Fp16Optimizer(object):
       if wd > 1:
         loss_scale *= wd
         dist.all_reduce(flattened_grads)
-        torch.cuda.synchronize()
 
       norm = norm.to(flattened_grads.device)
       norm = norm + fused_norm(flattened_grads)**2
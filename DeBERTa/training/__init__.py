@@ -1,3 +1,3 @@
 from .trainer import DistributedTrainer, set_random_seed
 from .dist_launcher import initialize_distributed,kill_children
-from ._utils import batch_to,batch_apply
+from ._utils import batch_to,batch_apply,packed_collate,PackedBatch
@@ -21,7 +21,7 @@ logger = get_logger()
 
 from .dist_launcher import get_ngpu
 from .optimizer_utils import create_xoptimizer
-from ._utils import batch_to
+from ._utils import batch_to, packed_collate
 
 def set_random_seed(seed, cpu_only=False):
   random.seed(seed)
@@ -70,7 +70,7 @@ class DistributedTrainer:
     data_fn return tuples (training_dataset, training_steps, train_sampler, batch_scheduler), training_dataset is required
     loss_fn return the loss of current mini-batch and the size of the batch
     optimizer_fn return the created optimizer
-    eval_fn return metrics for model selection
+    eval_fn return metrics for model selection, or None if the metrics are not computed on the current rank
     """
     self.__dict__.update(kwargs)
     self.args = args
@@ -126,7 +126,7 @@ class DistributedTrainer:
       batch_sampler = DistributedBatchSampler(batch_sampler, rank = rank, world_size = world_size)
       batch_sampler.next = self.trainer_state.next_batch
       num_workers = getattr(self.args, 'workers', 2)
-      train_dataloader = DataLoader(self.train_data, batch_sampler=batch_sampler, num_workers=num_workers, worker_init_fn=self.init_fn, pin_memory=True)
+      train_dataloader = DataLoader(self.train_data, batch_sampler=batch_sampler, num_workers=num_workers, worker_init_fn=self.init_fn, collate_fn=packed_collate, pin_memory=True)
       torch.cuda.empty_cache()
       for step, batch in enumerate(AsyncDataLoader(train_dataloader, 100)):
         if self.trainer_state.steps >= self.training_steps:
@@ -167,10 +167,12 @@ class DistributedTrainer:
     _steps = self.trainer_state.best_steps
     if self.eval_fn is not None:
       metric = self.eval_fn(self, self.model, self.device, tag=f'{self.trainer_state.steps:06}-{self.training_steps}')
-      if metric > _metric:
-        _metric = metric
-        _steps = self.trainer_state.steps
-      logger.info(f'Best metric: {_metric}@{_steps}')
+      # eval_fn returns None on ranks that don't compute the metrics
+      if metric is not None:
+        if metric > _metric:
+          _metric = metric
+          _steps = self.trainer_state.steps
+        logger.info(f'Best metric: {_metric}@{_steps}')
     self.trainer_state.best_metric, self.trainer_state.best_steps =  _metric, _steps
 
   def _train_step(self, data, bs_scale):